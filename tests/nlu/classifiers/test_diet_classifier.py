@@ -1,13 +1,18 @@
+import functools
+import itertools
+import math
 from pathlib import Path
 
 import numpy as np
 import pytest
-from unittest.mock import Mock
-from typing import List, Text, Dict, Any
+import tensorflow as tf
+from typing import List, Text, Dict, Any, Optional, Generator, Tuple, Iterable
 from _pytest.monkeypatch import MonkeyPatch
+from _pytest.tmpdir import TempPathFactory
 
 import rasa.model
 from rasa.shared.nlu.training_data.features import Features
+from rasa.shared.nlu.training_data.loading import load_data
 import rasa.nlu.train
 from rasa.nlu.classifiers import LABEL_RANKING_LENGTH
 from rasa.nlu.config import RasaNLUModelConfig
@@ -39,13 +44,25 @@ from rasa.utils.tensorflow.constants import (
 from rasa.nlu.components import ComponentBuilder
 from rasa.nlu.tokenizers.whitespace_tokenizer import WhitespaceTokenizer
 from rasa.nlu.classifiers.diet_classifier import DIETClassifier
-from rasa.nlu.model import Interpreter
+from rasa.nlu.model import Interpreter, Trainer
 from rasa.shared.nlu.training_data.message import Message
 from rasa.shared.nlu.training_data.training_data import TrainingData
 from rasa.utils import train_utils
 from rasa.shared.constants import DIAGNOSTIC_DATA
 
 
+@pytest.fixture(scope="module", autouse=True)
+def clear_keras_session() -> Generator[None, None, None]:
+    """Releases the Keras state of the models trained in this module once at the end.
+
+    Every `RasaModel` already clears the session when it's created, hence this
+    fixture doesn't add any clearing between the tests.
+    """
+    yield
+
+    tf.keras.backend.clear_session()
+
+
 def test_compute_default_label_features():
     label_features = [
         Message(data={TEXT: "test a"}),
@@ -58,10 +75,9 @@ def test_compute_default_label_features():
 
     output = output[0]
 
-    for i, o in enumerate(output):
-        assert isinstance(o, np.ndarray)
-        assert o[0][i] == 1
-        assert o.shape == (1, len(label_features))
+    assert isinstance(output, np.ndarray)
+    assert output.shape == (len(label_features), 1, len(label_features))
+    assert np.array_equal(np.asarray(output)[:, 0, :], np.eye(len(label_features)))
 
 
 @pytest.mark.parametrize(
@@ -172,18 +188,24 @@ async def _train_persist_load_with_different_settings(
     component_builder: ComponentBuilder,
     tmp_path: Path,
     should_finetune: bool,
-):
+    prior_persisted_path: Optional[Text] = None,
+) -> Text:
     _config = RasaNLUModelConfig({"pipeline": pipeline, "language": "en"})
 
-    (trainer, trained, persisted_path) = await rasa.nlu.train.train(
-        _config,
-        path=str(tmp_path),
-        data="data/examples/rasa/demo-rasa-multi-intent.yml",
-        component_builder=component_builder,
-    )
+    if prior_persisted_path:
+        # reuse the model persisted by a previous call instead of training again
+        persisted_path = prior_persisted_path
+        reference = Interpreter.load(persisted_path, component_builder)
+    else:
+        (trainer, reference, persisted_path) = await rasa.nlu.train.train(
+            _config,
+            path=str(tmp_path),
+            data="data/examples/rasa/demo-rasa-multi-intent.yml",
+            component_builder=component_builder,
+        )
+        assert trainer.pipeline
 
-    assert trainer.pipeline
-    assert trained.pipeline
+    assert reference.pipeline
 
     loaded = Interpreter.load(
         persisted_path,
@@ -192,7 +214,9 @@ async def _train_persist_load_with_different_settings(
     )
 
     assert loaded.pipeline
-    assert loaded.parse("Rasa is great!") == trained.parse("Rasa is great!")
+    assert loaded.parse("Rasa is great!") == reference.parse("Rasa is great!")
+
+    return persisted_path
 
 
 @pytest.mark.skip_on_windows
@@ -209,11 +233,15 @@ async def test_train_persist_load_with_different_settings_non_windows(
         {"name": "CountVectorsFeaturizer"},
         {"name": "DIETClassifier", MASKED_LM: True, EPOCHS: 1},
     ]
-    await _train_persist_load_with_different_settings(
+    persisted_path = await _train_persist_load_with_different_settings(
         pipeline, component_builder, tmp_path, should_finetune=False
     )
     await _train_persist_load_with_different_settings(
-        pipeline, component_builder, tmp_path, should_finetune=True
+        pipeline,
+        component_builder,
+        tmp_path,
+        should_finetune=True,
+        prior_persisted_path=persisted_path,
     )
 
 
@@ -224,11 +252,15 @@ async def test_train_persist_load_with_different_settings(component_builder, tmp
         {"name": "CountVectorsFeaturizer"},
         {"name": "DIETClassifier", LOSS_TYPE: "margin", EPOCHS: 1},
     ]
-    await _train_persist_load_with_different_settings(
+    persisted_path = await _train_persist_load_with_different_settings(
         pipeline, component_builder, tmpdir, should_finetune=False
     )
     await _train_persist_load_with_different_settings(
-        pipeline, component_builder, tmpdir, should_finetune=True
+        pipeline,
+        component_builder,
+        tmpdir,
+        should_finetune=True,
+        prior_persisted_path=persisted_path,
     )
 
 
@@ -246,11 +278,15 @@ async def test_train_persist_load_with_only_entity_recognition(
             EPOCHS: 1,
         },
     ]
-    await _train_persist_load_with_different_settings(
+    persisted_path = await _train_persist_load_with_different_settings(
         pipeline, component_builder, tmpdir, should_finetune=False
     )
     await _train_persist_load_with_different_settings(
-        pipeline, component_builder, tmpdir, should_finetune=True
+        pipeline,
+        component_builder,
+        tmpdir,
+        should_finetune=True,
+        prior_persisted_path=persisted_path,
     )
 
 
@@ -268,11 +304,15 @@ async def test_train_persist_load_with_only_intent_classification(
             EPOCHS: 1,
         },
     ]
-    await _train_persist_load_with_different_settings(
+    persisted_path = await _train_persist_load_with_different_settings(
         pipeline, component_builder, tmpdir, should_finetune=False
     )
     await _train_persist_load_with_different_settings(
-        pipeline, component_builder, tmpdir, should_finetune=True
+        pipeline,
+        component_builder,
+        tmpdir,
+        should_finetune=True,
+        prior_persisted_path=persisted_path,
     )
 
 
@@ -304,30 +344,90 @@ def as_pipeline(*components):
     return [{"name": c} for c in components]
 
 
+@functools.lru_cache()
+def _load_cached_training_data(data_path: Text, language: Text) -> TrainingData:
+    """Loads the training data only once per test worker.
+
+    `Trainer.train` works on a deep copy of the passed training data, hence the
+    loaded data can be shared between the trainings in this module.
+    """
+    return load_data(data_path, language)
+
+
+def _train_with_cached_data(
+    _config: RasaNLUModelConfig,
+    data_path: Text,
+    component_builder: ComponentBuilder,
+    path: Optional[Text] = None,
+) -> Tuple[Trainer, Interpreter, Optional[Text]]:
+    """Trains a pipeline on training data which is only loaded once per data path.
+
+    This deliberately skips `rasa.nlu.train.train` (e.g. printing the data stats and
+    the checks for experimental features) and should only be used by tests which
+    check the behavior of DIET itself.
+    """
+    trainer = Trainer(_config, component_builder)
+    trained = trainer.train(_load_cached_training_data(data_path, _config.language))
+
+    if path:
+        persisted_path = trainer.persist(path)
+    else:
+        persisted_path = None
+
+    return trainer, trained, persisted_path
+
+
+def _sums_to_1(values: Iterable[float]) -> bool:
+    return abs(math.fsum(values) - 1) <= 1e-6
+
+
+MANY_INTENTS_DATA_PATH = "data/test/many_intents.yml"
+MANY_INTENTS_DIET_PARAMS = {RANDOM_SEED: 42, EPOCHS: 1}
+
+
+@pytest.fixture(scope="session")
+def trained_diet_many_intents_path(
+    component_builder: ComponentBuilder, tmp_path_factory: TempPathFactory
+) -> Text:
+    """Trains DIET once on `many_intents.yml` and returns the persisted model path.
+
+    `RANKING_LENGTH` is only applied at prediction time, hence models which differ
+    only in this parameter can share the trained weights.
+    """
+    pipeline = as_pipeline(
+        "WhitespaceTokenizer", "CountVectorsFeaturizer", "DIETClassifier"
+    )
+    pipeline[2].update(MANY_INTENTS_DIET_PARAMS)
+
+    _config = RasaNLUModelConfig({"pipeline": pipeline})
+    (_, _, persisted_path) = _train_with_cached_data(
+        _config,
+        MANY_INTENTS_DATA_PATH,
+        component_builder,
+        str(tmp_path_factory.mktemp("diet_many_intents")),
+    )
+    return persisted_path
+
+
 @pytest.mark.parametrize(
     "classifier_params, data_path, output_length, output_should_sum_to_1",
     [
+        (MANY_INTENTS_DIET_PARAMS, MANY_INTENTS_DATA_PATH, 10, True,),  # default config
         (
-            {RANDOM_SEED: 42, EPOCHS: 1},
-            "data/test/many_intents.yml",
-            10,
-            True,
-        ),  # default config
-        (
-            {RANDOM_SEED: 42, RANKING_LENGTH: 0, EPOCHS: 1},
-            "data/test/many_intents.yml",
+            {**MANY_INTENTS_DIET_PARAMS, RANKING_LENGTH: 0},
+            MANY_INTENTS_DATA_PATH,
             LABEL_RANKING_LENGTH,
             False,
         ),  # no normalization
         (
-            {RANDOM_SEED: 42, RANKING_LENGTH: 3, EPOCHS: 1},
-            "data/test/many_intents.yml",
+            {**MANY_INTENTS_DIET_PARAMS, RANKING_LENGTH: 3},
+            MANY_INTENTS_DATA_PATH,
             3,
             True,
         ),  # lower than default ranking_length
         (
-            {RANDOM_SEED: 42, RANKING_LENGTH: 12, EPOCHS: 1},
-            "data/test/many_intents.yml",
+            {**MANY_INTENTS_DIET_PARAMS, RANKING_LENGTH: 12},
+            MANY_INTENTS_DATA_PATH,
             LABEL_RANKING_LENGTH,
             False,
         ),  # higher than default ranking_length
@@ -339,44 +439,69 @@ def as_pipeline(*components):
         ),  # less intents than default ranking_length
     ],
 )
-async def test_softmax_normalization(
+def test_softmax_normalization(
     component_builder,
-    tmp_path,
+    trained_diet_many_intents_path: Text,
     classifier_params,
     data_path: Text,
     output_length,
     output_should_sum_to_1,
 ):
-    pipeline = as_pipeline(
-        "WhitespaceTokenizer", "CountVectorsFeaturizer", "DIETClassifier"
-    )
-    assert pipeline[2]["name"] == "DIETClassifier"
-    pipeline[2].update(classifier_params)
+    training_params = {
+        key: value for key, value in classifier_params.items() if key != RANKING_LENGTH
+    }
+    if (
+        data_path == MANY_INTENTS_DATA_PATH
+        and training_params == MANY_INTENTS_DIET_PARAMS
+    ):
+        # only the ranking length differs, which doesn't require retraining
+        interpreter = Interpreter.load(
+            trained_diet_many_intents_path, component_builder
+        )
+        classifier = interpreter.pipeline[-1]
+        assert isinstance(classifier, DIETClassifier)
+        if RANKING_LENGTH in classifier_params:
+            classifier.component_config[RANKING_LENGTH] = classifier_params[
+                RANKING_LENGTH
+            ]
+    else:
+        pipeline = as_pipeline(
+            "WhitespaceTokenizer", "CountVectorsFeaturizer", "DIETClassifier"
+        )
+        assert pipeline[2]["name"] == "DIETClassifier"
+        pipeline[2].update(classifier_params)
 
-    _config = RasaNLUModelConfig({"pipeline": pipeline})
-    (trained_model, _, persisted_path) = await rasa.nlu.train.train(
-        _config,
-        path=str(tmp_path),
-        data=data_path,
-        component_builder=component_builder,
-    )
-    loaded = Interpreter.load(persisted_path, component_builder)
+        _config = RasaNLUModelConfig({"pipeline": pipeline})
+        (_, interpreter, _) = _train_with_cached_data(
+            _config, data_path, component_builder
+        )
 
-    parse_data = loaded.parse("hello")
+    parse_data = interpreter.parse("hello")
     intent_ranking = parse_data.get("intent_ranking")
     # check that the output was correctly truncated after normalization
     assert len(intent_ranking) == output_length
 
     # check whether normalization had the expected effect
-    output_sums_to_1 = sum(
-        [intent.get("confidence") for intent in intent_ranking]
-    ) == pytest.approx(1)
+    output_sums_to_1 = _sums_to_1(intent.get("confidence") for intent in intent_ranking)
     assert output_sums_to_1 == output_should_sum_to_1
 
     # check whether the normalization of rankings is reflected in intent prediction
     assert parse_data.get("intent") == intent_ranking[0]
 
 
+def _count_normalize_calls(monkeypatch: MonkeyPatch) -> List[int]:
+    """Records calls of `train_utils.normalize` without changing its behavior."""
+    calls = []
+    normalize = train_utils.normalize
+
+    def counting_normalize(*args: Any, **kwargs: Any) -> np.ndarray:
+        calls.append(1)
+        return normalize(*args, **kwargs)
+
+    monkeypatch.setattr(train_utils, "normalize", counting_normalize)
+    return calls
+
+
 @pytest.mark.parametrize(
     "classifier_params, data_path",
     [
@@ -391,9 +516,8 @@ async def test_softmax_normalization(
         ),
     ],
 )
-async def test_inner_linear_normalization(
+def test_inner_linear_normalization(
     component_builder: ComponentBuilder,
-    tmp_path: Path,
     classifier_params: Dict[Text, Any],
     data_path: Text,
     monkeypatch: MonkeyPatch,
@@ -405,39 +529,30 @@ async def test_inner_linear_normalization(
     pipeline[2].update(classifier_params)
 
     _config = RasaNLUModelConfig({"pipeline": pipeline})
-    (trained_model, _, persisted_path) = await rasa.nlu.train.train(
-        _config,
-        path=str(tmp_path),
-        data=data_path,
-        component_builder=component_builder,
-    )
-    loaded = Interpreter.load(persisted_path, component_builder)
+    (_, trained, _) = _train_with_cached_data(_config, data_path, component_builder)
 
-    mock = Mock()
-    monkeypatch.setattr(train_utils, "normalize", mock.normalize)
+    normalize_calls = _count_normalize_calls(monkeypatch)
 
-    parse_data = loaded.parse("hello")
+    parse_data = trained.parse("hello")
     intent_ranking = parse_data.get("intent_ranking")
 
     # check whether normalization had the expected effect
-    output_sums_to_1 = sum(
-        [intent.get("confidence") for intent in intent_ranking]
-    ) == pytest.approx(1)
+    output_sums_to_1 = _sums_to_1(intent.get("confidence") for intent in intent_ranking)
     assert output_sums_to_1
 
     # check whether the normalization of rankings is reflected in intent prediction
     assert parse_data.get("intent") == intent_ranking[0]
 
     # normalize shouldn't have been called
-    mock.normalize.assert_not_called()
+    assert not normalize_calls
 
 
 @pytest.mark.parametrize(
     "classifier_params, output_length",
     [({LOSS_TYPE: "margin", RANDOM_SEED: 42, EPOCHS: 1}, LABEL_RANKING_LENGTH)],
 )
-async def test_margin_loss_is_not_normalized(
-    monkeypatch, component_builder, tmpdir, classifier_params, output_length
+def test_margin_loss_is_not_normalized(
+    monkeypatch, component_builder, classifier_params, output_length
 ):
     pipeline = as_pipeline(
         "WhitespaceTokenizer", "CountVectorsFeaturizer", "DIETClassifier"
@@ -445,23 +560,18 @@ async def test_margin_loss_is_not_normalized(
     assert pipeline[2]["name"] == "DIETClassifier"
     pipeline[2].update(classifier_params)
 
-    mock = Mock()
-    monkeypatch.setattr(train_utils, "normalize", mock.normalize)
+    normalize_calls = _count_normalize_calls(monkeypatch)
 
     _config = RasaNLUModelConfig({"pipeline": pipeline})
-    (trained_model, _, persisted_path) = await rasa.nlu.train.train(
-        _config,
-        path=str(tmpdir),
-        data="data/test/many_intents.yml",
-        component_builder=component_builder,
+    (_, trained, _) = _train_with_cached_data(
+        _config, "data/test/many_intents.yml", component_builder
     )
-    loaded = Interpreter.load(persisted_path, component_builder)
 
-    parse_data = loaded.parse("hello")
+    parse_data = trained.parse("hello")
     intent_ranking = parse_data.get("intent_ranking")
 
     # check that the output was not normalized
-    mock.normalize.assert_not_called()
+    assert not normalize_calls
 
     # check that the output was correctly truncated
     assert len(intent_ranking) == output_length
@@ -471,7 +581,7 @@ async def test_margin_loss_is_not_normalized(
 
 
 @pytest.mark.timeout(120, func_only=True)
-async def test_set_random_seed(component_builder, tmpdir, nlu_as_json_path: Text):
+def test_set_random_seed(component_builder, nlu_as_json_path: Text):
     """test if train result is the same for two runs of tf embedding"""
 
     # set fixed random seed
@@ -487,28 +597,24 @@ async def test_set_random_seed(component_builder, tmpdir, nlu_as_json_path: Text
     )
 
     # first run
-    (trained_a, _, persisted_path_a) = await rasa.nlu.train.train(
-        _config,
-        path=tmpdir.strpath + "_a",
-        data=nlu_as_json_path,
-        component_builder=component_builder,
+    (_, trained_a, _) = _train_with_cached_data(
+        _config, nlu_as_json_path, component_builder
     )
+    result_a = trained_a.parse("hello")["intent"]["confidence"]
     # second run
-    (trained_b, _, persisted_path_b) = await rasa.nlu.train.train(
-        _config,
-        path=tmpdir.strpath + "_b",
-        data=nlu_as_json_path,
-        component_builder=component_builder,
+    (_, trained_b, _) = _train_with_cached_data(
+        _config, nlu_as_json_path, component_builder
     )
-
-    loaded_a = Interpreter.load(persisted_path_a, component_builder)
-    loaded_b = Interpreter.load(persisted_path_b, component_builder)
-    result_a = loaded_a.parse("hello")["intent"]["confidence"]
-    result_b = loaded_b.parse("hello")["intent"]["confidence"]
+    result_b = trained_b.parse("hello")["intent"]["confidence"]
 
     assert result_a == result_b
 
 
+def _count_files(directory: Path, limit: int) -> int:
+    """Counts the files in `directory` and its subdirectories up to `limit`."""
+    return sum(1 for _ in itertools.islice(directory.rglob("*.*"), limit))
+
+
 @pytest.mark.parametrize("log_level", ["epoch", "batch"])
 async def test_train_tensorboard_logging(
     log_level: Text,
@@ -556,8 +662,8 @@ async def test_train_tensorboard_logging(
 
     assert tensorboard_log_dir.exists()
 
-    all_files = list(tensorboard_log_dir.rglob("*.*"))
-    assert len(all_files) == 2
+    # stop counting as soon as there are more files than expected
+    assert _count_files(tensorboard_log_dir, limit=3) == 2
 
 
 async def test_train_model_checkpointing(
@@ -581,7 +687,7 @@ async def test_train_model_checkpointing(
                 },
                 {
                     "name": "DIETClassifier",
-                    EPOCHS: 5,
+                    EPOCHS: 1,
                     CONSTRAIN_SIMILARITIES: True,
                     MODEL_CONFIDENCE: "linear_norm",
                     CHECKPOINT_MODEL: True,
@@ -609,8 +715,7 @@ async def test_train_model_checkpointing(
         - component_1_CountVectorsFeaturizer (as per the pipeline above)
         - component_2_DIETClassifier files (more than 1 file)
     """
-    all_files = list(best_model_file.rglob("*.*"))
-    assert len(all_files) > 4
+    assert _count_files(best_model_file, limit=5) == 5
 
 
 @pytest.mark.parametrize(
@@ -655,13 +760,19 @@ async def test_process_gives_diagnostic_data(
     """Tests if processing a message returns attention weights as numpy array."""
     interpreter = response_selector_interpreter
     message = Message(data={TEXT: "hello"})
-    for component in interpreter.pipeline:
+    diet_index = next(
+        index
+        for index, component in enumerate(interpreter.pipeline)
+        if isinstance(component, DIETClassifier)
+    )
+    # components after DIETClassifier don't affect its diagnostic data
+    for component in interpreter.pipeline[: diet_index + 1]:
         component.process(message)
 
     diagnostic_data = message.get(DIAGNOSTIC_DATA)
 
-    # The last component is DIETClassifier, which should add attention weights
-    name = f"component_{len(interpreter.pipeline) - 2}_DIETClassifier"
+    # DIETClassifier should add attention weights
+    name = f"component_{diet_index}_DIETClassifier"
     assert isinstance(diagnostic_data, dict)
     assert name in diagnostic_data
     assert "attention_weights" in diagnostic_data[name]